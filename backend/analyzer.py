@@ -9,6 +9,7 @@ import chess.engine
 import chess.pgn
 import db
 import tortoise.exceptions
+from tortoise.transactions import in_transaction
 from anyio.streams.memory import MemoryObjectReceiveStream
 from pgn_feed import PgnFeed
 from sanic.log import logger
@@ -26,28 +27,53 @@ class Totals:
     moves_left: Optional[int] = None
 
 
-def get_totals(info_bundle: list[chess.engine.InfoDict]) -> Totals:
+@dataclasses.dataclass
+class Variation:
+    nodes: int
+    q_score: int
+    mate_score: Optional[int]
+    white_score: int
+    draw_score: int
+    black_score: int
+    moves_left: Optional[int]
+    pv: List[chess.Move]
+
+
+def get_variation(info: chess.engine.InfoDict) -> Variation:
+    score: chess.engine.Score = info.get(
+        "score", chess.engine.PovScore(chess.engine.Cp(0), chess.WHITE)
+    ).white()
+    wdl: chess.engine.Wdl = info.get(
+        "wdl", chess.engine.PovWdl(chess.engine.Wdl(0, 1000, 0), chess.WHITE)
+    ).white()
+    return Variation(
+        nodes=info.get("nodes", 0),
+        q_score=score.score(mate_score=20000),
+        mate_score=score.mate() if score.is_mate() else None,
+        white_score=wdl.wins,
+        draw_score=wdl.draws,
+        black_score=wdl.losses,
+        moves_left=info.get("movesleft"),
+        pv=info.get("pv", []),
+    )
+
+
+def get_totals(variations: list[Variation]) -> Totals:
     totals = Totals(
         nodes=0,
         score_q=0,
         score_white=0,
         score_draw=0,
         score_black=0,
-        moves_left=info_bundle[0].get("movesleft"),
+        moves_left=variations[0].moves_left,
     )
-    for info in info_bundle:
-        nodes = info.get("nodes", 0)
+    for var in variations:
+        nodes = var.nodes
         totals.nodes += nodes
-        score: chess.engine.Score = info.get(
-            "score", chess.engine.PovScore(chess.engine.Cp(0), chess.WHITE)
-        ).white()
-        wdl: chess.engine.Wdl = info.get(
-            "wdl", chess.engine.PovWdl(chess.engine.Wdl(0, 1000, 0), chess.WHITE)
-        ).white()
-        totals.score_q += nodes * score.score(mate_score=20000)
-        totals.score_white += nodes * wdl.wins
-        totals.score_draw += nodes * wdl.draws
-        totals.score_black += nodes * wdl.losses
+        totals.score_q += nodes * var.q_score
+        totals.score_white += nodes * var.white_score
+        totals.score_draw += nodes * var.draw_score
+        totals.score_black += nodes * var.black_score
     totals.score_q = round(totals.score_q / totals.nodes)
     totals.score_white = round(totals.score_white / totals.nodes)
     totals.score_black = round(totals.score_black / totals.nodes)
@@ -55,29 +81,14 @@ def get_totals(info_bundle: list[chess.engine.InfoDict]) -> Totals:
     return totals
 
 
-def get_leaf_board(pgn: chess.pgn.Game) -> chess.Board:
-    board = pgn.board()
-    for move in pgn.mainline_moves():
-        board.push(move)
-    return board
-
-
 def make_pv_san_string(board: chess.Board, pv: List[chess.Move]) -> str:
-    board = board.copy()
-    sans: list[str] = []
-    for move in pv:
-        sans.append(board.san(move))
-        board.push(move)
-    return " ".join(sans)
+    # Not using variation_san() as the frontend expects no move numbers.
+    board = board.copy(stack=False)
+    return " ".join(board.san_and_push(move) for move in pv)
 
 
-def make_pv_uci_string(board: chess.Board, pv: List[chess.Move]) -> str:
-    board = board.copy()
-    moves = []
-    for move in pv:
-        moves.append(move.uci())
-        board.push(move)
-    return " ".join(moves)
+def make_pv_uci_string(pv: List[chess.Move]) -> str:
+    return " ".join(move.uci() for move in pv)
 
 
 class Analyzer:
@@ -107,88 +118,94 @@ class Analyzer:
         self._uci_cancelation_lock = anyio.Lock()
         self._movetime_estimator = MovetimeEstimator("300+10")
 
-    # returns the last ply number.
+    # returns the last position and the board after the last move.
     async def _update_game_db(
         self, pgn: chess.pgn.Game, game: db.Game
-    ) -> db.GamePosition:
+    ) -> tuple[db.GamePosition, chess.Board]:
         board = pgn.board()
         white_clock: Optional[int] = None
         black_clock: Optional[int] = None
 
+        existing_positions: dict[int, db.GamePosition] = {
+            p.ply_number: p for p in await db.GamePosition.filter(game=game)
+        }
+        mismatched_ids: list[int] = []
         added_game_positions: list[db.GamePosition] = []
+        diverged = False
+
+        def needs_pos(ply: int, move_uci: Optional[str]) -> bool:
+            nonlocal diverged
+            res = existing_positions.get(ply)
+            if res is None:
+                return True
+            if not diverged:
+                # While the moves match the FENs match too, so the FEN is only
+                # compared for the start position. Everything after the first
+                # mismatch is stale.
+                if res.move_uci == move_uci and (ply > 0 or res.fen == board.fen()):
+                    return False
+                logger.error(
+                    f"Move UCI mismatch: {res.move_uci} != {move_uci}, "
+                    f"ply={ply}, fen={res.fen}"
+                )
+                diverged = True
+            mismatched_ids.append(res.id)
+            return True
 
-        async def create_pos(
+        def add_pos(
             ply: int,
             move_uci: Optional[str],
             move_san: Optional[str],
-        ) -> db.GamePosition:
-            res, created = await db.GamePosition.get_or_create(
-                game=game,
-                ply_number=ply,
-                defaults={
-                    "fen": board.fen(),
-                    "move_uci": move_uci,
-                    "move_san": move_san,
-                    "white_clock": white_clock,
-                    "black_clock": black_clock,
-                    "nodes": 0,
-                    "q_score": 0,
-                    "white_score": 0,
-                    "draw_score": 0,
-                    "black_score": 0,
-                },
+        ) -> None:
+            added_game_positions.append(
+                db.GamePosition(
+                    game=game,
+                    ply_number=ply,
+                    fen=board.fen(),
+                    move_uci=move_uci,
+                    move_san=move_san,
+                    white_clock=white_clock,
+                    black_clock=black_clock,
+                    nodes=0,
+                    q_score=0,
+                    white_score=0,
+                    draw_score=0,
+                    black_score=0,
+                )
             )
-            if created:
-                added_game_positions.append(res)
-            else:
-                if res.move_uci != move_uci or res.fen != board.fen():
-                    logger.error(
-                        f"Move UCI mismatch: {res.move_uci} != {move_uci}, "
-                        f"{res.fen}!={board.fen()} ply={ply}"
-                    )
-                    await res.delete()
-                    res = await db.GamePosition.create(
-                        game=game,
-                        ply_number=ply,
-                        fen=board.fen(),
-                        move_uci=move_uci,
-                        move_san=move_san,
-                        white_clock=white_clock,
-                        black_clock=black_clock,
-                        nodes=0,
-                        q_score=0,
-                        white_score=0,
-                        draw_score=0,
-                        black_score=0,
-                    )
-                    added_game_positions.append(res)
 
-            return res
-
-        last_pos: db.GamePosition = await create_pos(
-            ply=0,
-            move_uci=None,
-            move_san=None,
-        )
-
-        for ply, node in enumerate(pgn.mainline(), start=1):
+        if needs_pos(ply=0, move_uci=None):
+            add_pos(ply=0, move_uci=None, move_san=None)
+        last_ply = 0
+        for last_ply, node in enumerate(pgn.mainline(), start=1):
             clock = node.clock()
             if clock:
                 if board.turn == chess.WHITE:
                     white_clock = int(clock)
                 else:
                     black_clock = int(clock)
-            san = board.san(node.move)
-            board.push(move=node.move)
-            last_pos = await create_pos(
-                ply=ply,
-                move_uci=node.move.uci(),
-                move_san=san,
+            move_uci = node.move.uci()
+            # SAN and FEN are only needed for the positions to insert.
+            if needs_pos(ply=last_ply, move_uci=move_uci):
+                san = board.san_and_push(node.move)
+                add_pos(ply=last_ply, move_uci=move_uci, move_san=san)
+            else:
+                board.push(node.move)
+
+        if mismatched_ids:
+            await db.GamePosition.filter(id__in=mismatched_ids).delete()
+        if added_game_positions:
+            await db.GamePosition.bulk_create(
+                added_game_positions, ignore_conflicts=True
             )
+        last_pos = existing_positions.get(last_ply)
+        if last_pos is None or last_pos.id in mismatched_ids:
+            # bulk_create() doesn't populate primary keys, so refetch the tip.
+            last_pos = await db.GamePosition.get(game=game, ply_number=last_ply)
         await self._ws_notifier.send_game_update(
             game_id=game.id, positions=added_game_positions
         )
-        return last_pos
+        return last_pos, board
 
     def get_game(self) -> Optional[db.Game]:
         return self._game
@@ -253,9 +270,12 @@ class Analyzer:
         with pgn_recv_stream:
             try:
                 pgn: Optional[chess.pgn.Game] = None
+                board: Optional[chess.Board] = None
+                last_moves: Optional[list[chess.Move]] = None
                 while True:
                     async with anyio.create_task_group() as tg:
                         if pgn is not None:
+                            assert board is not None
                             assert self._current_position is not None
                             logger.info(
                                 f"Processing position {self._current_position.fen}"
@@ -267,15 +287,20 @@ class Analyzer:
                                     logger.error(f"Invalid TimeControl: [{tc}]")
                             tg.start_soon(
                                 self._uci_worker_think,
-                                get_leaf_board(pgn),
+                                board,
                                 self._current_position,
                                 game,
                             )
                         while True:
                             pgn = await pgn_recv_stream.receive()
-                            last_pos: db.GamePosition = await self._update_game_db(
-                                pgn, game
-                            )
+                            # Lichess often republishes the same PGN with only
+                            # clock updates, which wouldn't add any positions.
+                            moves = list(pgn.mainline_moves())
+                            if moves == last_moves:
+                                logger.debug("Mainline didn't change, skip.")
+                                continue
+                            last_moves = moves
+                            last_pos, board = await self._update_game_db(pgn, game)
                             if self._current_position == last_pos:
                                 logger.warning(
                                     "New position is the same as the last one, skip."
@@ -334,9 +359,10 @@ class Analyzer:
                 logger.info(f"Starting thinking: {board.fen()}, ply {pos.ply_number}")
                 await self._uci_cancelation_lock.acquire()
                 options: dict[str, str] = self.uci_options(game, pos)
+                max_multipv: int = self._config["max_multipv"]
                 with await self._engine.analysis(
                     board=board,
-                    multipv=self._config["max_multipv"],
+                    multipv=max_multipv,
                     options=options,
                 ) as analysis:
                     self._uci_cancelation_lock.release()
@@ -345,20 +371,19 @@ class Analyzer:
                     )
                     assert game is not None
                     await self._ws_notifier.send_game_update(game.id, positions=[pos])
-                    multipv = min(
-                        self._config["max_multipv"], board.legal_moves.count()
-                    )
+                    multipv = min(max_multipv, board.legal_moves.count())
                     info_bundle: list[chess.engine.InfoDict] = []
                     async for info in analysis:
-                        if "multipv" not in info:
+                        info_multipv = info.get("multipv")
+                        if info_multipv is None:
                             logger.warning(f"Got info without multipv: {info}")
                             continue
-                        if info["multipv"] != len(info_bundle) + 1:
+                        if info_multipv != len(info_bundle) + 1:
                             logger.error(f"Got info for wrong multipv: {info}")
                             info_bundle = []
                             continue
                         info_bundle.append(info)
-                        if len(info_bundle) == multipv:
+                        if info_multipv == multipv:
                             await self._process_info_bundle(
                                 info_bundle=info_bundle,
                                 board=board,
@@ -379,65 +404,79 @@ class Analyzer:
         board: chess.Board,
         pos: db.GamePosition,
     ):
-        totals: Totals = get_totals(info_bundle)
+        variations: list[Variation] = [get_variation(info) for info in info_bundle]
+        totals: Totals = get_totals(variations)
         logger.debug(f"Total nodes: {totals.nodes}")
         # logger.debug(info_bundle[0])
-        evaluation: db.GamePositionEvaluation = await db.GamePositionEvaluation.create(
-            position=pos,
-            nodes=totals.nodes,
-            time=int(info_bundle[0].get("time", 0) * 1000),
-            depth=info_bundle[0].get("depth", 0),
-            seldepth=info_bundle[0].get("seldepth", 0),
-        )
+        fmove = info_bundle[0]
+        time: Optional[float] = fmove.get("time")
+        depth: Optional[int] = fmove.get("depth")
+        seldepth: Optional[int] = fmove.get("seldepth")
 
-        def make_eval_move(info: chess.engine.InfoDict):
-            pv: List[chess.Move] = info.get("pv", [])
-            assert len(pv) > 0
-            move: chess.Move = pv[0]
-            score: chess.engine.Score = info.get(
-                "score", chess.engine.PovScore(chess.engine.Cp(0), chess.WHITE)
-            ).white()
-            wdl: chess.engine.Wdl = info.get(
-                "wdl", chess.engine.PovWdl(chess.engine.Wdl(0, 1000, 0), chess.WHITE)
-            ).white()
-            return db.GamePositionEvaluationMove(
-                evaluation=evaluation,
-                nodes=info.get("nodes", 0),
-                move_uci=move.uci(),
-                move_san=board.san(move),
-                q_score=score.score(mate_score=20000),
-                pv_san=make_pv_san_string(board, pv),
-                pv_uci=make_pv_uci_string(board, pv),
-                mate_score=score.mate() if score.is_mate() else None,
-                white_score=wdl.wins,
-                draw_score=wdl.draws,
-                black_score=wdl.losses,
-                moves_left=info.get("movesleft", None),
+        shown_variations = variations[: self._config.get("show_pv", 2)]
+        pv_strings: list[tuple[str, str]] = []
+        for var in shown_variations:
+            assert len(var.pv) > 0
+            pv_strings.append(
+                (make_pv_san_string(board, var.pv), make_pv_uci_string(var.pv))
             )
 
-        moves: List[db.GamePositionEvaluationMove] = [
-            make_eval_move(info)
-            for info in info_bundle[: self._config.get("show_pv", 2)]
-        ]
         try:
-            await db.GamePositionEvaluationMove.bulk_create(moves)
+            async with in_transaction():
+                evaluation: db.GamePositionEvaluation = (
+                    await db.GamePositionEvaluation.create(
+                        position=pos,
+                        nodes=totals.nodes,
+                        time=int((time or 0) * 1000),
+                        depth=depth or 0,
+                        seldepth=seldepth or 0,
+                    )
+                )
+                moves: List[db.GamePositionEvaluationMove] = [
+                    db.GamePositionEvaluationMove(
+                        evaluation=evaluation,
+                        nodes=var.nodes,
+                        q_score=var.q_score,
+                        pv_san=pv_san,
+                        pv_uci=pv_uci,
+                        mate_score=var.mate_score,
+                        white_score=var.white_score,
+                        draw_score=var.draw_score,
+                        black_score=var.black_score,
+                        moves_left=var.moves_left,
+                    )
+                    for var, (pv_san, pv_uci) in zip(shown_variations, pv_strings)
+                ]
+                await db.GamePositionEvaluationMove.bulk_create(moves)
+                # Only touch pos once the moves are stored, it outlives this
+                # bundle.
+                pos.nodes = totals.nodes
+                pos.q_score = totals.score_q
+                pos.white_score = totals.score_white
+                pos.draw_score = totals.score_draw
+                pos.black_score = totals.score_black
+                pos.moves_left = totals.score_black
+                update_fields = [
+                    "nodes",
+                    "q_score",
+                    "white_score",
+                    "draw_score",
+                    "black_score",
+                    "moves_left",
+                ]
+                if time is not None:
+                    pos.time = int(time * 1000)
+                    update_fields.append("time")
+                if depth is not None:
+                    pos.depth = depth
+                    update_fields.append("depth")
+                if seldepth is not None:
+                    pos.seldepth = seldepth
+                    update_fields.append("seldepth")
+                await pos.save(update_fields=update_fields)
         except tortoise.exceptions.IntegrityError as e:
             logger.error(f"Database insertion error: {e}")
             return
-        pos.nodes = totals.nodes
-        pos.q_score = totals.score_q
-        pos.white_score = totals.score_white
-        pos.draw_score = totals.score_draw
-        pos.black_score = totals.score_black
-        pos.moves_left = totals.score_black
-        fmove = info_bundle[0]
-        if "time" in fmove:
-            pos.time = int(fmove.get("time", 0) * 1000)
-        if "depth" in fmove:
-            pos.depth = fmove.get("depth", 0)
-        if "seldepth" in fmove:
-            pos.seldepth = fmove.get("seldepth", 0)
-        await pos.save()
         game = self._game
         assert game is not None
         await self._ws_notifier.send_game_update(
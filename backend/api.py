@@ -2,7 +2,6 @@ import json
 
 import db
 from sanic import Blueprint, Request, Websocket
-from sanic.helpers import json_dumps
 from sanic.log import logger
 from ws_notifier import (WebsocketNotifier, WebsocketRequest,
                          WebsocketResponse, make_games_data)
@@ -13,7 +12,6 @@ api = Blueprint("api", url_prefix="/api")
 
 @api.websocket("/ws")
 async def ws(req: Request, ws: Websocket):
-    games = await db.Game.all()
     analyzed_games = set(g.id for g in req.app.ctx.app.get_games_being_analyzed())
     games = await db.Game.filter(
         Q(tournament__is_hidden=False) | Q(is_finished=False),
@@ -26,7 +24,7 @@ async def ws(req: Request, ws: Websocket):
         ws_notifier.register(ws)
         resp["status"] = req.app.ctx.app.get_status()
         resp["games"] = make_games_data(games=games, analyzed_games=analyzed_games)
-        await ws.send(json_dumps(resp))
+        await ws_notifier.send_response(ws, resp)
         while True:
             data = await ws.recv()
             if not data:
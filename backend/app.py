@@ -59,36 +59,25 @@ class App:
         await self._ws_notifier.send_response(ws, response)
 
     async def dump_eval(self, ws, game_id: int, ply: int):
-        pos: db.GamePosition | None = await db.GamePosition.get_or_none(
-            game=game_id, ply_number=ply
-        )
-        if pos is None:
-            return
         evaluations: list[db.GamePositionEvaluation] = (
-            await db.GamePositionEvaluation.filter(position=pos).order_by("-id")[:1]
+            await db.GamePositionEvaluation.filter(
+                position__game=game_id, position__ply_number=ply
+            ).order_by("-id")[:1]
         )
-        evaluation = evaluations[0] if evaluations else None
-        moveses_flat: list[db.GamePositionEvaluationMove] = (
-            (
-                await db.GamePositionEvaluationMove.filter(
-                    evaluation=evaluation
-                ).order_by("-nodes")
-            )
-            if evaluation
-            else []
+        if not evaluations:
+            return
+        moves: list[db.GamePositionEvaluationMove] = (
+            await db.GamePositionEvaluationMove.filter(
+                evaluation=evaluations[0]
+            ).order_by("-nodes")
         )
-        moveses: list[list[db.GamePositionEvaluationMove]] = [[] for _ in evaluations]
-        eval_id_to_idx = {e.id: idx for idx, e in enumerate(evaluations)}
-        for move in moveses_flat:
-            if move.evaluation_id in eval_id_to_idx:
-                moveses[eval_id_to_idx[move.evaluation_id]].append(move)
 
         response = WebsocketResponse(
             evaluations=make_evaluations_update(
                 game_id=game_id,
                 ply=ply,
                 evaluations=evaluations,
-                moves=moveses,
+                moves=[moves],
             )
         )
         await self._ws_notifier.send_response(ws, response)
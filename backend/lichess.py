@@ -2,6 +2,7 @@ import io
 import json
 
 import aiohttp
+import anyio.to_thread
 import chess.pgn
 import ndjson
 
@@ -42,7 +43,11 @@ async def fetch_round_pgns(round_id: str) -> list[chess.pgn.Game]:
         ) as response:
             response.raise_for_status()
             text = io.StringIO(await response.text())
-            res = []
-            while pgn := chess.pgn.read_game(text):
-                res.append(pgn)
-            return res
+            return await anyio.to_thread.run_sync(_read_games, text)
+
+
+def _read_games(text: io.StringIO) -> list[chess.pgn.Game]:
+    res = []
+    while pgn := chess.pgn.read_game(text):
+        res.append(pgn)
+    return res
@@ -27,6 +27,8 @@ app.blueprint(api)
 @app.before_server_start
 async def setup(app, loop):
     await Tortoise.generate_schemas()
+    # Started separately, so that websockets keep being served if analysis fails.
+    app.add_task(app.ctx.app.get_ws_notifier().run)
     app.add_task(app.ctx.app.run)
 
 
@@ -6,6 +6,7 @@ import chess.pgn
 from anyio.streams.memory import MemoryObjectSendStream
 from sanic.log import logger
 import anyio
+import anyio.to_thread
 import aiohttp.client_exceptions
 
 
@@ -29,7 +30,10 @@ class PgnFeed:
         await self._worker(pgn_url)
 
     async def _maybe_send_game(self, buf: str) -> bool:
-        game = chess.pgn.read_game(StringIO(buf.strip()))
+        # Parsing a long PGN takes tens of ms, don't block the event loop on it.
+        game = await anyio.to_thread.run_sync(
+            chess.pgn.read_game, StringIO(buf.strip())
+        )
         assert game is not None
         if all(game.headers.get(k) == v for k, v in self.filters):
             logger.debug(
@@ -1,10 +1,12 @@
 import dataclasses
-from typing import Optional, TypedDict
+from typing import NotRequired, Optional, TypedDict
 
 import anyio
+import anyio.abc
 import db
+import orjson
+from anyio.streams.memory import MemoryObjectReceiveStream, MemoryObjectSendStream
 from sanic import Websocket
-from sanic.helpers import json_dumps
 from sanic.log import logger
 from websockets.exceptions import ConnectionClosed
 from sanic.exceptions import WebsocketClosed
@@ -46,7 +48,8 @@ class WsPositionData(TypedDict):
     ply: int  # 0 for startpos
     moveUci: Optional[str]
     moveSan: Optional[str]
-    fen: str
+    # Omitted in evaluation updates, the client already knows it by then.
+    fen: NotRequired[str]
     whiteClock: Optional[int]
     blackClock: Optional[int]
     scoreQ: Optional[int]
@@ -101,6 +104,11 @@ class WebsocketResponse(TypedDict, total=False):
     evaluations: list[WsEvaluationData]
 
 
+def encode_response(response: WebsocketResponse) -> str:
+    # Decoded since bytes would go out as a binary websocket frame.
+    return orjson.dumps(response).decode()
+
+
 def make_game_data(game: db.Game, is_being_analyzed: bool) -> WsGameData:
     return WsGameData(
         gameId=game.id,
@@ -134,6 +142,7 @@ def make_evaluations_update(
     evaluations: list[db.GamePositionEvaluation],
     moves: list[list[db.GamePositionEvaluationMove]],
 ) -> list[WsEvaluationData]:
+    last_idx = len(evaluations) - 1
     return [
         WsEvaluationData(
             gameId=game_id,
@@ -144,8 +153,8 @@ def make_evaluations_update(
             depth=eval_.depth,
             seldepth=eval_.seldepth,
             movesLeft=eval_.moves_left,
-            variations=[
-                (
+            variations=(
+                [
                     WsVariationData(
                         nodes=move.nodes,
                         pvSan=move.pv_san,
@@ -156,72 +165,136 @@ def make_evaluations_update(
                         scoreB=move.black_score,
                         mateScore=move.mate_score,
                     )
-                    if i == len(evaluations) - 1
-                    else WsVariationData(
-                        nodes=move.nodes,
-                    )
-                )
-                for move in moves
-            ],
+                    for move in moves
+                ]
+                if i == last_idx
+                else [WsVariationData(nodes=move.nodes) for move in moves]
+            ),
         )
         for i, (eval_, moves) in enumerate(zip(evaluations, moves))
     ]
 
 
+def make_position_data(
+    game_id: int, pos: db.GamePosition, include_fen: bool
+) -> WsPositionData:
+    res = WsPositionData(
+        gameId=game_id,
+        ply=pos.ply_number,
+        moveUci=pos.move_uci,
+        moveSan=pos.move_san,
+        whiteClock=pos.white_clock,
+        blackClock=pos.black_clock,
+        scoreQ=pos.q_score,
+        scoreW=pos.white_score,
+        scoreD=pos.draw_score,
+        scoreB=pos.black_score,
+        movesLeft=pos.moves_left,
+        nodes=pos.nodes,
+        time=pos.time,
+        depth=pos.depth,
+        seldepth=pos.seldepth,
+    )
+    if include_fen:
+        res["fen"] = pos.fen
+    return res
+
+
 def make_positions_update(
     game_id: int,
     positions: list[db.GamePosition],
+    include_fen: bool = True,
 ) -> list[WsPositionData]:
-    return [
-        WsPositionData(
-            gameId=game_id,
-            ply=pos.ply_number,
-            moveUci=pos.move_uci,
-            moveSan=pos.move_san,
-            fen=pos.fen,
-            whiteClock=pos.white_clock,
-            blackClock=pos.black_clock,
-            scoreQ=pos.q_score,
-            scoreW=pos.white_score,
-            scoreD=pos.draw_score,
-            scoreB=pos.black_score,
-            movesLeft=pos.moves_left,
-            nodes=pos.nodes,
-            time=pos.time,
-            depth=pos.depth,
-            seldepth=pos.seldepth,
-        )
-        for pos in positions
-    ]
+    return [make_position_data(game_id, pos, include_fen) for pos in positions]
 
 
 @dataclasses.dataclass
 class WebsocketSubscription:
     ws: Websocket
+    # Frames waiting to be sent to the websocket.
+    send_stream: MemoryObjectSendStream[str]
     game_id: Optional[int] = None
     ply: Optional[int] = None
 
 
 class WebsocketNotifier:
+    # Clients that fall this many frames behind are disconnected.
+    MAX_PENDING_FRAMES = 8
+
     _subscriptions: dict[Websocket, WebsocketSubscription]
+    # Same subscriptions indexed by game_id, so that per-game updates don't
+    # have to scan all subscribers.
+    _game_subscriptions: dict[int, dict[Websocket, WebsocketSubscription]]
+    # Runs a sender task per websocket, so that producers don't wait for slow
+    # clients.
+    _background_tg: Optional[anyio.abc.TaskGroup]
 
     def __init__(self):
         self._subscriptions = dict()
+        self._game_subscriptions = dict()
+        self._background_tg = None
+
+    async def run(
+        self, *, task_status: anyio.abc.TaskStatus[None] = anyio.TASK_STATUS_IGNORED
+    ):
+        async with anyio.create_task_group() as tg:
+            self._background_tg = tg
+            task_status.started()
+            await anyio.sleep_forever()
 
     def register(self, ws: Websocket) -> None:
-        self._subscriptions[ws] = WebsocketSubscription(ws=ws)
+        send_stream, receive_stream = anyio.create_memory_object_stream[str](
+            max_buffer_size=self.MAX_PENDING_FRAMES
+        )
+        self._subscriptions[ws] = WebsocketSubscription(ws=ws, send_stream=send_stream)
+        assert self._background_tg is not None
+        self._background_tg.start_soon(self._sender, ws, receive_stream)
 
     def unregister(self, ws: Websocket) -> None:
-        self._subscriptions.pop(ws)
+        entry = self._subscriptions.pop(ws)
+        entry.send_stream.close()
+        self._remove_game_subscription(entry)
+
+    async def _sender(
+        self, ws: Websocket, receive_stream: MemoryObjectReceiveStream[str]
+    ):
+        # Errors must not reach the shared task group, that would take down
+        # all other websockets.
+        with receive_stream:
+            try:
+                async for text in receive_stream:
+                    await self.send_text(ws, text)
+            except Exception as e:
+                logger.error(f"Websocket send failed, stopping sender: {e}")
+
+    async def _close(self, ws: Websocket):
+        try:
+            await ws.close()
+        except Exception as e:
+            logger.error(f"Websocket close failed: {e}")
+
+    def _remove_game_subscription(self, entry: WebsocketSubscription) -> None:
+        if entry.game_id is None:
+            return
+        game_subs = self._game_subscriptions[entry.game_id]
+        game_subs.pop(entry.ws)
+        if not game_subs:
+            del self._game_subscriptions[entry.game_id]
 
     def num_subscribers(self) -> int:
         return len(self._subscriptions)
 
+    def has_game_subscribers(self, game_id: int) -> bool:
+        return game_id in self._game_subscriptions
+
     def set_game_and_ply(
         self, ws: Websocket, game_id: int, ply: Optional[int] = None
     ) -> bool:
         entry = self._subscriptions[ws]
         game_changed = entry.game_id != game_id
+        if game_changed:
+            self._remove_game_subscription(entry)
+            self._game_subscriptions.setdefault(game_id, dict())[ws] = entry
         entry.game_id = game_id
         entry.ply = ply
         return game_changed
@@ -239,10 +312,16 @@ class WebsocketNotifier:
         evaluations: Optional[list[db.GamePositionEvaluation]] = None,
         moves: Optional[list[list[db.GamePositionEvaluationMove]]] = None,
     ):
+        if not self.has_game_subscribers(game_id):
+            return
         response = WebsocketResponse()
         if positions is not None:
             response.update(
-                positions=make_positions_update(game_id=game_id, positions=positions)
+                positions=make_positions_update(
+                    game_id=game_id,
+                    positions=positions,
+                    include_fen=evaluations is None,
+                )
             )
         if evaluations is not None:
             assert moves is not None
@@ -265,7 +344,21 @@ class WebsocketNotifier:
             pass
 
     async def send_response(self, ws: Websocket, response: WebsocketResponse):
-        await self.send_text(ws, json_dumps(response))
+        try:
+            await self._subscriptions[ws].send_stream.send(encode_response(response))
+        except (anyio.ClosedResourceError, anyio.BrokenResourceError):
+            pass
+
+    def _enqueue(self, sub: WebsocketSubscription, text: str) -> None:
+        try:
+            sub.send_stream.send_nowait(text)
+        except anyio.WouldBlock:
+            logger.warning("Websocket client is too slow, disconnecting.")
+            sub.send_stream.close()
+            assert self._background_tg is not None
+            self._background_tg.start_soon(self._close, sub.ws)
+        except (anyio.ClosedResourceError, anyio.BrokenResourceError):
+            pass
 
     async def notify_observers(
         self,
@@ -273,13 +366,17 @@ class WebsocketNotifier:
         game_id: Optional[int] = None,
         ply: Optional[int] = None,
     ) -> None:
-        subs = list(self._subscriptions.values())
-
-        raw_response = json_dumps(response)
-        async with anyio.create_task_group() as tg:
-            for sub in subs:
-                if game_id is not None and sub.game_id != game_id:
-                    continue
-                if ply is not None and sub.ply != ply:
-                    continue
-                tg.start_soon(self.send_text, sub.ws, raw_response)
+        candidates = (
+            self._subscriptions
+            if game_id is None
+            else self._game_subscriptions.get(game_id, {})
+        )
+        subs = [
+            sub for sub in candidates.values() if ply is None or sub.ply == ply
+        ]
+        if not subs:
+            return
+
+        raw_response = encode_response(response)
+        for sub in subs:
+            self._enqueue(sub, raw_response)
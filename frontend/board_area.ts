@@ -186,7 +186,7 @@ export class BoardArea {
     this.positionIsOngoing = isOngoing;
     this.lastUpdateTimestamp = Date.now();
     if (isChanged) {
-      this.board.fromFen(position.fen);
+      if (position.fen != null) this.board.fromFen(position.fen);
       if (nextMoveUci) this.renderMovePlayedOutline(nextMoveUci);
       this.board.clearHighlights();
       if (position.moveUci) {
@@ -202,7 +202,8 @@ export class BoardArea {
 
   private updateClocks(): void {
     if (!this.currentPosition) return;
-    const whiteToMove: boolean = this.currentPosition.fen.split(' ')[1] === 'w';
+    const whiteToMove: boolean =
+        this.currentPosition.fen?.split(' ')[1] === 'w';
     const white = this.flipped ? 'top' : 'bottom';
     const black = this.flipped ? 'bottom' : 'top';
     let thinkingTimeMs = this.currentPosition.time;
@@ -249,7 +249,9 @@ export class MoveList {
       };
       this.positions.push(emptyPosition);
     }
-    this.positions[position.ply] = position;
+    // Evaluation updates don't carry the FEN, keep the one we already have.
+    this.positions[position.ply] =
+        {...this.positions[position.ply], ...position};
 
     const move_idx = Math.floor((position.ply + 1) / 2);
     const is_black = (position.ply % 2) === 0;
@@ -309,6 +311,9 @@ export class MoveList {
         this.parent.scrollHeight - this.parent.scrollTop ===
         this.parent.clientHeight;
     positions.forEach(position => {
+      // An update without FEN may arrive before the position itself (e.g.
+      // while the game is being loaded), the full position will follow.
+      if (position.fen == null && !this.positions[position.ply]?.fen) return;
       this.updateSinglePosition(position);
       if (position.ply > 0) {
         const prevPos = this.positions[position.ply - 1];
@@ -32,7 +32,7 @@ export interface WsPositionData {
   ply: number;  // 0 for startpos
   moveUci?: string;
   moveSan?: string;
-  fen: string;
+  fen?: string;  // Omitted in evaluation updates.
   whiteClock?: number;
   blackClock?: number;
   scoreQ?: number;